@@ -2,10 +2,16 @@ import streamlit as st
 import sqlite3
 from datetime import date, datetime
 import uuid
+import hashlib
+import json
+import logging
 import os
 import re
+import threading
 import time
 
+import numpy as np
+import pandas as pd
 import stripe
 from openai import OpenAI
 from openai import RateLimitError, AuthenticationError
@@ -24,16 +30,14 @@ client = OpenAI(api_key=OPENAI_API_KEY)
 if STRIPE_SECRET_KEY:
     stripe.api_key = STRIPE_SECRET_KEY
 
+log = logging.getLogger(__name__)
+
 
 # ===============================
 # DB
 # ===============================
-conn = sqlite3.connect("menu_ai.db", check_same_thread=False)
-cur = conn.cursor()
-
-
-def ensure_table_schema():
-    cur.execute("""
+def ensure_table_schema(c):
+    c.execute("""
     CREATE TABLE IF NOT EXISTS usage (
         user_id TEXT,
         day TEXT,
@@ -42,7 +46,7 @@ def ensure_table_schema():
     )
     """)
 
-    cur.execute("""
+    c.execute("""
     CREATE TABLE IF NOT EXISTS history (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id TEXT,
@@ -59,7 +63,10 @@ def ensure_table_schema():
     )
     """)
 
-    cur.execute("""
+    # ✅ load_history（user_idで絞って新しい順）の絞り込みと並び替えをインデックスで行う（ソート不要）
+    c.execute("CREATE INDEX IF NOT EXISTS idx_history_user_id ON history(user_id, id DESC)")
+
+    c.execute("""
     CREATE TABLE IF NOT EXISTS subscriptions (
         user_id TEXT PRIMARY KEY,
         stripe_customer_id TEXT,
@@ -70,10 +77,37 @@ def ensure_table_schema():
         updated_at TEXT
     )
     """)
-    conn.commit()
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS prompt_cache (
+        key TEXT PRIMARY KEY,
+        scope TEXT,
+        embedding BLOB,
+        result TEXT,
+        created_at TEXT
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_prompt_cache_scope ON prompt_cache(scope)")
+    c.commit()
+
+
+@st.cache_resource(show_spinner=False)
+def get_conn():
+    """接続は1プロセス1回だけ（PRAGMA・テーブル作成もここで1回だけ）
+    全セッションで共有するので、書き込みトランザクションは一緒に返すロックで守る"""
+    c = sqlite3.connect("menu_ai.db", check_same_thread=False, cached_statements=256)
+    c.executescript("""
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=134217728;
+    PRAGMA cache_size=-20000;
+    """)
+    ensure_table_schema(c)
+    return c, threading.RLock()
 
 
-ensure_table_schema()
+conn, db_lock = get_conn()
 
 
 # ===============================
@@ -89,91 +123,124 @@ else:
 today = str(date.today())
 
 
+# ===============================
+# SQL（同じ文字列を使い回す → sqlite3の文キャッシュに乗る）
+# ===============================
+SQL_GET_COUNT = "SELECT count FROM usage WHERE user_id=? AND day=?"
+
+SQL_INCREMENT_COUNT = """
+INSERT INTO usage (user_id, day, count) VALUES (?, ?, 1)
+ON CONFLICT(user_id, day) DO UPDATE SET count=count+1
+"""
+
+SQL_INSERT_HISTORY = """
+INSERT INTO history (user_id, created_at, mode, input_text, days, people, dishes, meals, methods, calorie, result)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+SQL_LOAD_HISTORY = """
+SELECT created_at, mode, input_text, result
+FROM history
+WHERE user_id=?
+ORDER BY id DESC
+LIMIT ?
+"""
+
+SQL_UPSERT_SUBSCRIPTION = """
+INSERT INTO subscriptions (user_id, stripe_customer_id, stripe_subscription_id, status, current_period_end, cancel_at_period_end, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(user_id) DO UPDATE SET
+  stripe_customer_id=excluded.stripe_customer_id,
+  stripe_subscription_id=excluded.stripe_subscription_id,
+  status=excluded.status,
+  current_period_end=excluded.current_period_end,
+  cancel_at_period_end=excluded.cancel_at_period_end,
+  updated_at=excluded.updated_at
+"""
+
+SQL_GET_SUBSCRIPTION = """
+SELECT stripe_customer_id, stripe_subscription_id, status, current_period_end, cancel_at_period_end
+FROM subscriptions
+WHERE user_id=?
+"""
+
+SQL_GET_CACHE = "SELECT result FROM prompt_cache WHERE key=?"
+
+SQL_LOAD_CACHE_EMBS = "SELECT key, embedding FROM prompt_cache WHERE scope=? AND embedding IS NOT NULL"
+
+# embeddingがNULL（キャッシュOFF等）の時は既存のembeddingを消さない
+SQL_PUT_CACHE = """
+INSERT INTO prompt_cache (key, scope, embedding, result, created_at)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT(key) DO UPDATE SET
+  scope=excluded.scope,
+  embedding=COALESCE(excluded.embedding, prompt_cache.embedding),
+  result=excluded.result,
+  created_at=excluded.created_at
+"""
+
+
 # ===============================
 # usage
 # ===============================
 def get_today_count(uid, day):
-    cur.execute("SELECT count FROM usage WHERE user_id=? AND day=?", (uid, day))
-    row = cur.fetchone()
+    row = conn.execute(SQL_GET_COUNT, (uid, day)).fetchone()
     return row[0] if row else 0
 
 
-def increment_count(uid, day):
-    count = get_today_count(uid, day)
-    if count == 0:
-        cur.execute("INSERT INTO usage (user_id, day, count) VALUES (?, ?, 1)", (uid, day))
-    else:
-        cur.execute("UPDATE usage SET count=? WHERE user_id=? AND day=?", (count + 1, uid, day))
-    conn.commit()
+def increment_count(uid, day, commit=True):
+    """commit=Falseの時は呼び出し側でdb_lockを持ってCOMMITすること"""
+    with db_lock:
+        conn.execute(SQL_INCREMENT_COUNT, (uid, day))
+        if commit:
+            conn.commit()
 
 
 # ===============================
 # history
 # ===============================
-def save_history(uid, mode, input_text, days, people, dishes, meals, methods, calorie, result):
-    cur.execute("""
-    INSERT INTO history (user_id, created_at, mode, input_text, days, people, dishes, meals, methods, calorie, result)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        uid,
-        datetime.now().isoformat(timespec="seconds"),
-        mode,
-        input_text,
-        days,
-        people,
-        dishes,
-        ",".join(meals) if meals else "",
-        ",".join(methods) if methods else "",
-        calorie,
-        result
-    ))
-    conn.commit()
+def save_history(uid, mode, input_text, days, people, dishes, meals, methods, calorie, result, commit=True):
+    """commit=Falseの時は呼び出し側でdb_lockを持ってCOMMITすること"""
+    with db_lock:
+        conn.execute(SQL_INSERT_HISTORY, (
+            uid,
+            datetime.now().isoformat(timespec="seconds"),
+            mode,
+            input_text,
+            days,
+            people,
+            dishes,
+            ",".join(meals) if meals else "",
+            ",".join(methods) if methods else "",
+            calorie,
+            result
+        ))
+        if commit:
+            conn.commit()
 
 
 def load_history(uid, limit=5):
-    cur.execute("""
-        SELECT created_at, mode, input_text, result
-        FROM history
-        WHERE user_id=?
-        ORDER BY id DESC
-        LIMIT ?
-    """, (uid, limit))
-    return cur.fetchall()
+    return conn.execute(SQL_LOAD_HISTORY, (uid, limit)).fetchall()
 
 
 # ===============================
 # subscription DB
 # ===============================
 def upsert_subscription(uid, customer_id, sub_id, status, current_period_end, cancel_at_period_end):
-    cur.execute("""
-    INSERT INTO subscriptions (user_id, stripe_customer_id, stripe_subscription_id, status, current_period_end, cancel_at_period_end, updated_at)
-    VALUES (?, ?, ?, ?, ?, ?, ?)
-    ON CONFLICT(user_id) DO UPDATE SET
-      stripe_customer_id=excluded.stripe_customer_id,
-      stripe_subscription_id=excluded.stripe_subscription_id,
-      status=excluded.status,
-      current_period_end=excluded.current_period_end,
-      cancel_at_period_end=excluded.cancel_at_period_end,
-      updated_at=excluded.updated_at
-    """, (
-        uid,
-        customer_id or "",
-        sub_id or "",
-        status or "",
-        int(current_period_end) if current_period_end else 0,
-        1 if cancel_at_period_end else 0,
-        datetime.now().isoformat(timespec="seconds")
-    ))
-    conn.commit()
+    with db_lock, conn:
+        conn.execute(SQL_UPSERT_SUBSCRIPTION, (
+            uid,
+            customer_id or "",
+            sub_id or "",
+            status or "",
+            int(current_period_end) if current_period_end else 0,
+            1 if cancel_at_period_end else 0,
+            datetime.now().isoformat(timespec="seconds")
+        ))
 
 
 def get_subscription(uid):
-    cur.execute("""
-    SELECT stripe_customer_id, stripe_subscription_id, status, current_period_end, cancel_at_period_end
-    FROM subscriptions
-    WHERE user_id=?
-    """, (uid,))
-    row = cur.fetchone()
+    row = conn.execute(SQL_GET_SUBSCRIPTION, (uid,)).fetchone()
     if not row:
         return None
     return {
@@ -226,6 +293,7 @@ def handle_return_from_stripe(uid: str):
                 cancel_at_period_end = bool(s.get("cancel_at_period_end", False))
 
                 upsert_subscription(uid, customer_id, sub_id, status, current_period_end, cancel_at_period_end)
+                refresh_subscription_from_stripe.clear()
                 st.success("✅ プレミアム登録が完了しました！")
 
                 # ✅ URLを掃除（毎回success表示されるの防止）
@@ -236,8 +304,9 @@ def handle_return_from_stripe(uid: str):
             st.error(f"⚠️ Stripe確認に失敗しました: {e}")
 
 
+@st.cache_data(ttl=300, show_spinner=False)
 def refresh_subscription_from_stripe(uid: str):
-    """毎回Stripeを見に行って “今の状態” をDBへ同期（Webhook無しでもズレにくい）"""
+    """Stripeを見に行って “今の状態” をDBへ同期（uidごとに5分に1回まで。操作後は.clear()で即同期）"""
     if not STRIPE_SECRET_KEY:
         return
 
@@ -261,9 +330,8 @@ def refresh_subscription_from_stripe(uid: str):
         return
 
 
-def is_premium(uid: str) -> bool:
-    """最終判定（active/trialingならプレミアム扱い）"""
-    sub = get_subscription(uid)
+def is_premium(sub) -> bool:
+    """最終判定（active/trialingならプレミアム扱い）。subはget_subscription()の結果"""
     if not sub:
         return False
 
@@ -292,6 +360,7 @@ def cancel_subscription_at_period_end(uid: str):
     try:
         sub_id = sub["stripe_subscription_id"]
         stripe.Subscription.modify(sub_id, cancel_at_period_end=True)
+        refresh_subscription_from_stripe.clear()
         refresh_subscription_from_stripe(uid)
         return True, "解約予約しました（期限まではプレミアム利用できます）"
     except Exception as e:
@@ -310,29 +379,206 @@ def cancel_subscription_immediately(uid: str):
     try:
         sub_id = sub["stripe_subscription_id"]
         stripe.Subscription.delete(sub_id)  # 即キャンセル
+        refresh_subscription_from_stripe.clear()
         refresh_subscription_from_stripe(uid)
         return True, "今すぐ解約しました"
     except Exception as e:
         return False, f"Stripe即解約エラー: {e}"
 
 
+# ===============================
+# LLM cache（同じ条件＋似た入力はAPIを呼ばない）
+# ===============================
+EMBED_MODEL = "text-embedding-3-small"
+SEMANTIC_THRESHOLD = 0.95
+
+if "cache_stats" not in st.session_state:
+    st.session_state.cache_stats = {"hits": 0, "misses": 0}
+
+
+def embed_text(text: str):
+    res = client.embeddings.create(model=EMBED_MODEL, input=text)
+    return np.asarray(res.data[0].embedding, dtype=np.float32)
+
+
+def normalize_input(text: str) -> str:
+    """改行・全角スペース・連続空白の違いは同じ入力として扱う"""
+    return " ".join(text.split())
+
+
+def cache_keys(model: str, max_tokens: int, template: str, params: dict, text: str):
+    """テンプレ＋条件（params）が完全一致する範囲をscope、その中で入力まで一致するものをkeyにする
+    （テンプレやembeddingモデルを変えたら古い結果は使わない＝次元の違うベクトルが混ざらない）"""
+    scope_src = json.dumps(
+        {
+            "model": model,
+            "max_tokens": max_tokens,
+            "embed_model": EMBED_MODEL,
+            "template": hashlib.sha256(template.encode()).hexdigest(),
+            **params
+        },
+        ensure_ascii=False, sort_keys=True
+    )
+    scope = hashlib.sha256(scope_src.encode()).hexdigest()
+    key = hashlib.sha256(f"{scope}|{text}".encode()).hexdigest()
+    return scope, key
+
+
+def load_cache_embeddings(scope: str):
+    """scope内の保存済みembeddingを正規化済みの1行列にまとめる（session_stateに保持、insertで破棄）"""
+    embs_by_scope = st.session_state.setdefault("cache_embs", {})
+    if scope not in embs_by_scope:
+        rows = conn.execute(SQL_LOAD_CACHE_EMBS, (scope,)).fetchall()
+        if rows:
+            embs = np.stack([np.frombuffer(r[1], dtype=np.float32) for r in rows])
+            embs /= np.linalg.norm(embs, axis=1, keepdims=True)
+        else:
+            embs = None
+        embs_by_scope[scope] = ([r[0] for r in rows], embs)
+    return embs_by_scope[scope]
+
+
+def semantic_lookup(scope: str, q):
+    """同じ条件の中で、入力のコサイン類似度がしきい値を超える過去の結果を返す"""
+    keys, embs = load_cache_embeddings(scope)
+    if embs is None:
+        return None
+
+    scores = embs @ (q / np.linalg.norm(q))
+    best = int(scores.argmax())
+    if scores[best] <= SEMANTIC_THRESHOLD:
+        return None
+
+    row = conn.execute(SQL_GET_CACHE, (keys[best],)).fetchone()
+    return row[0] if row else None
+
+
+def show_stream(stream) -> str:
+    """生成途中の文字をそのまま表示（完了したらプレビューは消して全文を返す）"""
+    live = st.empty()
+    with live.container():
+        st.write_stream(
+            ev.delta for ev in stream if ev.type == "response.output_text.delta"
+        )
+    result = stream.get_final_response().output_text
+    live.empty()
+    return result
+
+
+def embed_or_none(text: str):
+    try:
+        return embed_text(text)
+    except Exception:
+        return None
+
+
+def get_cache_or_none(key: str):
+    try:
+        row = conn.execute(SQL_GET_CACHE, (key,)).fetchone()
+    except Exception:
+        log.exception("prompt_cache lookup failed")
+        return None
+    return row[0] if row else None
+
+
+def semantic_lookup_or_none(scope: str, q):
+    try:
+        return semantic_lookup(scope, q)
+    except Exception:
+        log.exception("prompt_cache semantic lookup failed")
+        return None
+
+
+def put_cache(key: str, scope: str, emb, result: str):
+    """キャッシュ保存は失敗しても生成結果には影響させない（ログだけ残す）"""
+    try:
+        with db_lock, conn:
+            conn.execute(SQL_PUT_CACHE, (
+                key,
+                scope,
+                emb.tobytes() if emb is not None else None,
+                result,
+                datetime.now().isoformat(timespec="seconds")
+            ))
+    except Exception:
+        log.exception("prompt_cache write failed")
+        return
+    if emb is not None:
+        st.session_state.pop("cache_embs", None)
+
+
+def llm_cached_call(
+    template: str, prompt: str, model: str, max_tokens: int,
+    params: dict, text_input: str, use_cache: bool = True
+) -> str:
+    """条件＋正規化した入力のSHA-256でDBを引き、無ければ同条件の類似入力→APIの順"""
+    text = normalize_input(text_input)
+    scope, key = cache_keys(model, max_tokens, template, params, text)
+    stats = st.session_state.cache_stats
+
+    # ✅ キャッシュの読み書きはあくまで最適化（失敗したら普通に生成する）
+    if use_cache:
+        cached = get_cache_or_none(key)
+        if cached is not None:
+            stats["hits"] += 1
+            return cached
+
+    # ✅ embedding（~100ms）で先に類似検索し、外れた時だけ生成リクエストを投げる
+    emb = embed_or_none(text) if use_cache else None
+
+    # ✅ 同じ条件で入力が似ている（食材の順番・表記ゆれ等）結果を使い回す
+    if emb is not None:
+        cached = semantic_lookup_or_none(scope, emb)
+        if cached is not None:
+            stats["hits"] += 1
+            # ✅ 次回から同じ入力は完全一致で引けるように別名で保存
+            put_cache(key, scope, emb, cached)
+            return cached
+
+    stats["misses"] += 1
+
+    with client.responses.stream(
+        model=model,
+        input=prompt,
+        max_output_tokens=max_tokens
+    ) as stream:
+        result = show_stream(stream)
+
+    # ✅ キャッシュOFFでも結果は保存する（次回から使える）
+    put_cache(key, scope, emb, result)
+    return result
+
+
 # ===============================
 # helpers
 # ===============================
+SHOP_MARKER = "【買い物リスト】"
+_RE_DAY = re.compile(r"^(?P<day>\d+日目)[:：]\s*$")
+_RE_MENU = re.compile(r"【献立】([\s\S]*?)(?=\n【材料】|\n【作り方】|\n【買い物リスト】|$)")
+_RE_DAYBLOCKS = re.compile(r"(\d+日目：[\s\S]*?)(?=\n\d+日目：|$)")
+
+
 def parse_shopping_list(result_text: str):
-    shop_match = re.search(r"【買い物リスト】([\s\S]+)", result_text)
-    if not shop_match:
+    # ✅ 正規表現を使わず文字列検索で探す（最初のマーカー以降を使う）
+    idx = result_text.find(SHOP_MARKER)
+    if idx < 0:
         return None
 
-    block = shop_match.group(1).strip()
-    lines = [ln.strip() for ln in block.splitlines() if ln.strip()]
+    block = result_text[idx + len(SHOP_MARKER):]
+    if not block:
+        return None
 
-    day_pattern = re.compile(r"^(?P<day>\d+日目)[:：]\s*$")
     day_map = {}
     current_day = None
 
-    for ln in lines:
-        md = day_pattern.match(ln)
+    # ✅ 1パスで処理（strip済みリストを作らない）
+    for raw in block.splitlines():
+        ln = raw.strip()
+        if not ln:
+            continue
+
+        # ✅ 「〇日目：」で終わる行だけ正規表現にかける
+        md = _RE_DAY.match(ln) if ln.endswith(("日目:", "日目：")) else None
         if md:
             current_day = md.group("day")
             day_map.setdefault(current_day, [])
@@ -342,10 +588,7 @@ def parse_shopping_list(result_text: str):
         if not item:
             continue
 
-        if current_day:
-            day_map[current_day].append(item)
-        else:
-            day_map.setdefault("all", []).append(item)
+        day_map.setdefault(current_day or "all", []).append(item)
 
     has_day = any(k.endswith("日目") for k in day_map.keys())
     if has_day:
@@ -355,34 +598,106 @@ def parse_shopping_list(result_text: str):
 
 
 def uniq_keep_order(items):
-    seen = set()
-    out = []
-    for x in items:
-        if x not in seen:
-            out.append(x)
-            seen.add(x)
-    return out
+    return list(dict.fromkeys(items))
 
 
 def trim_menu_days(result_text: str, days: int) -> str:
     if days <= 0:
         return result_text
 
-    m = re.search(r"【献立】([\s\S]*?)(?=\n【材料】|\n【作り方】|\n【買い物リスト】|$)", result_text)
+    m = _RE_MENU.search(result_text)
     if not m:
         return result_text
 
-    menu_block = m.group(1)
-    day_blocks = re.findall(r"(\d+日目：[\s\S]*?)(?=\n\d+日目：|$)", menu_block)
-    if len(day_blocks) <= days:
+    # ✅ 献立部分だけを1回走査し、(days+1)日目の先頭で打ち切る（残りは見ない）
+    start, end = m.span(1)
+    first = cut = None
+    for i, block in enumerate(_RE_DAYBLOCKS.finditer(result_text, start, end)):
+        if i == 0:
+            first = block.start()
+        elif i == days:
+            cut = block.start()
+            break
+
+    if cut is None:
         return result_text
 
-    kept = "\n".join(day_blocks[:days]).strip()
-    new_menu = f"\n{kept}\n"
+    kept = result_text[first:cut].strip()
+    return f"{result_text[:start]}\n{kept}\n{result_text[end:]}"
 
-    start, end = m.span(1)
-    return result_text[:start] + new_menu + result_text[end:]
 
+# ===============================
+# プロンプト（format_mapで値を埋める）
+# ===============================
+RECIPE_PROMPT = """
+あなたは料理の先生です。
+
+【料理名】
+{text_input}
+
+【条件】
+・{people}人分（必ず守る）
+・家庭料理
+・初心者向け
+・材料と作り方は短くわかりやすく
+・現実的な材料のみ
+
+【出力形式】
+【料理名】
+（料理名）
+
+【材料】
+・材料名 分量
+
+【作り方】
+1. 手順
+2. 手順
+
+【買い物リスト】
+・材料名
+"""
+
+MENU_PROMPT = """
+あなたは一人暮らし向け献立アドバイザーです。
+
+【入力食材】
+{text_input}
+
+【条件】
+・日数：{days}日分（必ずこの日数だけ）
+・人数：{people}人分
+・食事の時間：{meals_text}
+・1食あたり：{dishes}品
+・目標カロリー：{calorie}kcal
+・調理条件：{method_text}
+
+【絶対ルール】
+・曜日（月曜など）は一切使わない
+・「1日目」「2日目」…の日数表記にする
+・{days}日分を超えない
+・入力食材以外は絶対に追加しない（調味料は例外OK）
+・各料理は「料理名 + 一言」も入れる
+
+【出力形式（必ずこの形）】
+【献立】
+1日目：
+{meals_text}：
+・料理名：一言
+（1食あたり{dishes}品）
+
+【材料】
+（料理ごとに）
+・材料名 分量
+
+【作り方】
+（料理ごとに短く）
+1. 手順
+2. 手順
+
+【買い物リスト】
+1日目：
+・材料
+"""
 
 # ===============================
 # UI
@@ -417,10 +732,12 @@ st.caption("✅ 食材＋条件で献立生成 / ✅ 料理名モードでレシ
 if STRIPE_SECRET_KEY and APP_BASE_URL:
     handle_return_from_stripe(user_id)
 
-# ✅ 重要：毎回Stripeから最新状態を同期（Webhook無しでも強い）
+# ✅ 重要：Stripeから最新状態を同期（Webhook無しでも強い / 5分キャッシュ）
 refresh_subscription_from_stripe(user_id)
 
-premium = is_premium(user_id)
+# ✅ subscriptionは1回だけ読んで判定・サイドバーで使い回す
+sub = get_subscription(user_id)
+premium = is_premium(sub)
 
 
 # ===============================
@@ -430,8 +747,6 @@ with st.sidebar:
     st.markdown("## 💎 プレミアム（月300円）")
     st.caption("✅ 無制限 / ✅ 制限解除")
 
-    sub = get_subscription(user_id)
-
     if premium:
         st.success("🌟 プレミアム有効")
 
@@ -483,16 +798,26 @@ with st.sidebar:
                 else:
                     st.error("Checkout作成に失敗しました（設定を確認）")
 
+    st.divider()
+    use_cache = st.checkbox("キャッシュを使う", value=True, key="use_cache")
+    stats = st.session_state.cache_stats
+    st.caption(f"キャッシュ：ヒット {stats['hits']} / ミス {stats['misses']}")
+
 
 # ===============================
 # ✅ 無料制限（1日1回）
 # ===============================
 MAX_FREE_PER_DAY = 1
-today_count = get_today_count(user_id, today)
 
 if premium:
     st.success("🌟 プレミアム：無制限（回数制限なし / 日数制限なし）")
 else:
+    # ✅ 回数は無料の時だけ、日付（とuid）が変わった時だけDBから読む（毎rerunでSELECTしない）
+    if st.session_state.get("usage_key") != (user_id, today):
+        st.session_state.usage_key = (user_id, today)
+        st.session_state.usage_count = get_today_count(user_id, today)
+    today_count = st.session_state.usage_count
+
     st.info(f"🆓 本日の利用回数：{today_count} / {MAX_FREE_PER_DAY}（無料は1日分まで）")
     if today_count >= MAX_FREE_PER_DAY:
         st.error("⚠️ 無料利用は1日1回までです（明日リセット）")
@@ -572,89 +897,53 @@ if run:
         st.warning("入力してください")
         st.stop()
 
+    # ✅ 表示用の回数はsession_stateのキャッシュなので、生成前だけはDBで再確認（別タブ対策）
+    if not premium:
+        st.session_state.usage_count = get_today_count(user_id, today)
+        if st.session_state.usage_count >= MAX_FREE_PER_DAY:
+            st.error("⚠️ 無料利用は1日1回までです（明日リセット）")
+            st.stop()
+
     method_text = "、".join(methods) if methods else "なし"
+    meals_text = "、".join(selected_meals)
 
     if recipe_mode:
-        prompt = f"""
-あなたは料理の先生です。
-
-【料理名】
-{text_input}
-
-【条件】
-・{people}人分（必ず守る）
-・家庭料理
-・初心者向け
-・材料と作り方は短くわかりやすく
-・現実的な材料のみ
-
-【出力形式】
-【料理名】
-（料理名）
-
-【材料】
-・材料名 分量
-
-【作り方】
-1. 手順
-2. 手順
-
-【買い物リスト】
-・材料名
-"""
+        template = RECIPE_PROMPT
+        prompt = template.format_map({"text_input": text_input, "people": people})
         mode_name = "料理名モード"
     else:
-        prompt = f"""
-あなたは一人暮らし向け献立アドバイザーです。
-
-【入力食材】
-{text_input}
-
-【条件】
-・日数：{days}日分（必ずこの日数だけ）
-・人数：{people}人分
-・食事の時間：{", ".join(selected_meals)}
-・1食あたり：{dishes}品
-・目標カロリー：{calorie}kcal
-・調理条件：{method_text}
-
-【絶対ルール】
-・曜日（月曜など）は一切使わない
-・「1日目」「2日目」…の日数表記にする
-・{days}日分を超えない
-・入力食材以外は絶対に追加しない（調味料は例外OK）
-・各料理は「料理名 + 一言」も入れる
-
-【出力形式（必ずこの形）】
-【献立】
-1日目：
-{", ".join(selected_meals)}：
-・料理名：一言
-（1食あたり{dishes}品）
-
-【材料】
-（料理ごとに）
-・材料名 分量
-
-【作り方】
-（料理ごとに短く）
-1. 手順
-2. 手順
-
-【買い物リスト】
-1日目：
-・材料
-"""
+        template = MENU_PROMPT
+        prompt = template.format_map({
+            "text_input": text_input,
+            "days": days,
+            "people": people,
+            "meals_text": meals_text,
+            "dishes": dishes,
+            "calorie": calorie,
+            "method_text": method_text,
+        })
         mode_name = "献立モード"
 
+    # ✅ キャッシュは「プロンプトに効く条件の完全一致」＋「入力の類似」で引く
+    if recipe_mode:
+        cache_params = {"mode": mode_name, "people": int(people)}
+    else:
+        cache_params = {
+            "mode": mode_name,
+            "days": int(days),
+            "people": int(people),
+            "dishes": int(dishes),
+            "meals": selected_meals,
+            "methods": sorted(methods),
+            "calorie": int(calorie),
+        }
+
     with st.spinner("生成中…"):
         try:
-            res = client.responses.create(
-                model="gpt-4.1-mini",
-                input=prompt,
-                max_output_tokens=900
+            result = llm_cached_call(
+                template, prompt, "gpt-4.1-mini", 900,
+                cache_params, text_input, use_cache=use_cache
             )
-            result = res.output_text
         except RateLimitError:
             st.error("⚠️ 混雑中です。少し待ってもう一回押してください。")
             st.stop()
@@ -668,14 +957,19 @@ if run:
     if not recipe_mode:
         result = trim_menu_days(result, int(days))
 
-    # 無料だけ回数カウント
-    if not premium:
-        increment_count(user_id, today)
+    # ✅ 回数カウント＋履歴保存はまとめて1回のCOMMIT（他セッションの書き込みと混ざらないようロック）
+    with db_lock, conn:
+        # 無料だけ回数カウント
+        if not premium:
+            increment_count(user_id, today, commit=False)
 
-    save_history(
-        user_id, mode_name, text_input, int(days), int(people), int(dishes),
-        selected_meals, methods, int(calorie), result
-    )
+        save_history(
+            user_id, mode_name, text_input, int(days), int(people), int(dishes),
+            selected_meals, methods, int(calorie), result, commit=False
+        )
+
+    if not premium:
+        st.session_state.usage_count += 1
 
     st.subheader("📄 結果")
     st.text(result)
@@ -689,16 +983,30 @@ if run:
         day_keys = [k for k in day_items.keys() if k.endswith("日目")]
         day_keys_sorted = sorted(day_keys, key=lambda x: int(x.replace("日目", ""))) if day_keys else []
 
+        # ✅ チェック欄は1つの表にまとめる（品目ごとにcheckboxを作らない）
         if day_keys_sorted:
-            for day_key in day_keys_sorted:
-                st.markdown(f"### {day_key}")
-                items = uniq_keep_order(day_items.get(day_key, []))
-                for idx, item in enumerate(items):
-                    st.checkbox(item, key=f"shop_{day_key}_{idx}_{hash(item)}")
+            shop_rows = [
+                {"買": False, "日": day_key, "品目": item}
+                for day_key in day_keys_sorted
+                for item in uniq_keep_order(day_items.get(day_key, []))
+            ]
         else:
-            items = uniq_keep_order(day_items.get("all", []))
-            for idx, item in enumerate(items):
-                st.checkbox(item, key=f"shop_all_{idx}_{hash(item)}")
+            shop_rows = [
+                {"買": False, "品目": item}
+                for item in uniq_keep_order(day_items.get("all", []))
+            ]
+
+        if not shop_rows:
+            st.write("買い物リストが見つかりませんでした。")
+        else:
+            shop_df = pd.DataFrame(shop_rows)
+            st.data_editor(
+                shop_df,
+                hide_index=True,
+                use_container_width=True,
+                disabled=[c for c in shop_df.columns if c != "買"],
+                key="shop_list"
+            )
 
     with st.expander("🕘 履歴（最新5件）"):
         rows = load_history(user_id, 5)